@@ -1,101 +1,229 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+import altair as alt
 from statsmodels.tsa.holtwinters import ExponentialSmoothing
 import io
 import xlsxwriter
 import re
+import importlib.util
+from joblib import Parallel, delayed
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(page_title="Consola Financiera IA", layout="wide", page_icon="📈")
 
 # --- FUNCIONES AUXILIARES ---
 
+# calamine (Rust) parsea xlsx/xls 5-20x más rápido que openpyxl; si no está instalado dejamos que pandas elija
+MOTOR_EXCEL = 'calamine' if importlib.util.find_spec('python_calamine') else None
+
 MAPA_MESES = {
     'ENERO': 1, 'FEBRERO': 2, 'MARZO': 3, 'ABRIL': 4, 'MAYO': 5, 'JUNIO': 6,
     'JULIO': 7, 'AGOSTO': 8, 'SEPTIEMBRE': 9, 'OCTUBRE': 10, 'NOVIEMBRE': 11, 'DICIEMBRE': 12
 }
+# Ordenados de mayor a menor longitud para que la alternancia nunca corte un nombre más largo.
+# El mes no puede estar pegado a otra letra (evita MAYO en "MAYORISTA"), pero sí a dígitos o "_" ("ENERO2024").
+PATRON_MESES = re.compile(r'(?<![^\W\d_])(' + '|'.join(sorted(MAPA_MESES, key=len, reverse=True)) + r')(?![^\W\d_])')
+
+PATRON_ANIO = re.compile(r'(20[2-3][0-9])')
+
+# Marcadores de los reportes (se comparan ya en mayúsculas)
+ENCABEZADO_MONTO = "MONTO"
+MARCA_TOTAL = "TOTAL"
+
+def mes_en_texto(texto):
+    match = PATRON_MESES.search(texto.upper())
+    return MAPA_MESES[match.group(1)] if match else None
 
 def escanear_mes_en_hoja(df_preview, nombre_pestana):
-    nombre_pestana_limpio = nombre_pestana.strip().upper()
-    for mes_nombre, mes_num in MAPA_MESES.items():
-        if mes_nombre in nombre_pestana_limpio:
-            return mes_num
-    contenido_texto = df_preview.to_string().upper()
-    for mes_nombre, mes_num in MAPA_MESES.items():
-        if mes_nombre in contenido_texto:
-            return mes_num
-    return None
+    mes_num = mes_en_texto(nombre_pestana)
+    if mes_num:
+        return mes_num
+    # Solo las celdas de texto pueden nombrar un mes: las unimos (sin to_string) y hacemos una sola búsqueda
+    celdas_texto = [c for c in df_preview.to_numpy().ravel() if isinstance(c, str)]
+    return mes_en_texto(' '.join(celdas_texto))
 
 def detectar_anio_archivo(nombre_archivo, anio_default):
-    match = re.search(r'(20[2-3][0-9])', nombre_archivo)
+    match = PATRON_ANIO.search(nombre_archivo)
     if match:
         return int(match.group(1)), True
     return anio_default, False
 
-def procesar_multiples_excels(archivos_subidos, anio_default_usuario):
-    lista_datos = []
+def procesar_archivo(nombre_archivo, contenido, anio_default_usuario):
+    # Sin llamadas a Streamlit: se ejecuta en procesos paralelos.
+    # Devuelve listas paralelas (mes absoluto año*12 + mes-1, venta) en lugar de una lista de dicts.
+    periodos = []
+    ventas = []
     log_errores = []
-    log_anios = []
 
-    for archivo in archivos_subidos:
+    anio_archivo, encontrado = detectar_anio_archivo(nombre_archivo, anio_default_usuario)
+    origen_anio = "Detectado en nombre" if encontrado else "Usado por defecto"
+    log_anio = f"📄 {nombre_archivo} -> Año {anio_archivo} ({origen_anio})"
+
+    try:
         try:
-            anio_archivo, encontrado = detectar_anio_archivo(archivo.name, anio_default_usuario)
-            origen_anio = "Detectado en nombre" if encontrado else "Usado por defecto"
-            log_anios.append(f"📄 {archivo.name} -> Año {anio_archivo} ({origen_anio})")
-
-            xls = pd.ExcelFile(archivo)
-            for nombre_hoja in xls.sheet_names:
-                df_preview = pd.read_excel(archivo, sheet_name=nombre_hoja, nrows=15, header=None)
-                mes_numero = escanear_mes_en_hoja(df_preview, nombre_hoja)
+            xls = pd.ExcelFile(io.BytesIO(contenido), engine=MOTOR_EXCEL)
+        except Exception:
+            if MOTOR_EXCEL is None:
+                raise
+            # Libro que calamine no entiende: reintentamos con el motor por defecto (openpyxl/xlrd)
+            xls = pd.ExcelFile(io.BytesIO(contenido))
+        for nombre_hoja in xls.sheet_names:
+            # Una sola lectura por hoja: mes y encabezado se detectan sobre las primeras 15 filas ya en memoria
+            df_hoja = xls.parse(nombre_hoja, header=None)
+            df_preview = df_hoja.head(15)
+            mes_numero = escanear_mes_en_hoja(df_preview, nombre_hoja)
+            
+            if mes_numero:
+                # Fila de encabezado: primera fila con una celda "MONTO" (una sola pasada vectorizada)
+                celdas = np.char.upper(df_preview.to_numpy(dtype=str))
+                hay_monto = (celdas == ENCABEZADO_MONTO).any(axis=1)
+                fila_encabezado = int(np.argmax(hay_monto)) if hay_monto.any() else -1
                 
-                if mes_numero:
-                    col_monto = None
-                    fila_encabezado = -1
-                    for i, row in df_preview.iterrows():
-                        fila_texto = row.astype(str).str.upper().tolist()
-                        if "MONTO" in fila_texto:
-                            fila_encabezado = i
-                            break
+                if fila_encabezado != -1:
+                    # Solo se usan dos columnas bajo el encabezado: MONTO y la primera (filtro de TOTAL)
+                    col_monto = int(np.argmax(celdas[fila_encabezado] == ENCABEZADO_MONTO))
+                    filas_datos = slice(fila_encabezado + 1, None)
                     
-                    if fila_encabezado != -1:
-                        df_datos = pd.read_excel(archivo, sheet_name=nombre_hoja, header=fila_encabezado)
-                        df_datos.columns = df_datos.columns.str.strip().str.upper()
-                        
-                        if 'MONTO' in df_datos.columns:
-                            df_datos['MONTO'] = pd.to_numeric(df_datos['MONTO'], errors='coerce')
-                            df_datos = df_datos.dropna(subset=['MONTO'])
-                            col_primera = df_datos.columns[0]
-                            df_datos = df_datos[~df_datos[col_primera].astype(str).str.upper().str.contains("TOTAL", na=False)]
-                            
-                            venta_mensual = df_datos['MONTO'].sum()
-                            fecha_construida = pd.Timestamp(year=anio_archivo, month=mes_numero, day=1)
-                            
-                            lista_datos.append({
-                                'Fecha': fecha_construida,
-                                'Ventas': venta_mensual,
-                                'Fuente': f"{archivo.name} ({anio_archivo})"
-                            })
-        except Exception as e:
-            log_errores.append(f"Error en {archivo.name}: {str(e)}")
-
-    if lista_datos:
-        df_final = pd.DataFrame(lista_datos)
-        df_final = df_final.groupby('Fecha').sum(numeric_only=True).sort_index()
-        if not df_final.empty:
-            idx_completo = pd.date_range(start=df_final.index.min(), end=df_final.index.max(), freq='MS')
-            df_final = df_final.reindex(idx_completo).fillna(0)
-            df_final.index.name = 'Fecha'
+                    montos = pd.to_numeric(df_hoja.iloc[filas_datos, col_monto], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan, copy=True)
+                    # Excluimos filas de totales con una máscara booleana sobre el ndarray de la primera columna;
+                    # solo necesitamos la suma, así que no se copia ningún DataFrame filtrado
+                    col_primera = np.char.upper(df_hoja.iloc[filas_datos, 0].to_numpy().astype(str))
+                    montos[np.char.find(col_primera, MARCA_TOTAL) >= 0] = np.nan
+                    
+                    periodos.append(anio_archivo * 12 + mes_numero - 1)
+                    ventas.append(float(np.nansum(montos)))
+    except Exception as e:
+        log_errores.append(f"Error en {nombre_archivo}: {str(e)}")
+
+    return periodos, ventas, log_errores, log_anio
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def procesar_multiples_excels(archivos_subidos, anio_default_usuario):
+    # archivos_subidos: tupla de (nombre, bytes) para que el caché sea estable entre reruns.
+    # max_entries acota la memoria: cada entrada retiene los bytes de los libros subidos.
+    periodos = []
+    ventas = []
+    log_errores = []
+    log_anios = []
+
+    # Cada libro es independiente: los repartimos entre núcleos (se pasan bytes, no UploadedFile)
+    n_jobs = -1 if len(archivos_subidos) > 1 else 1
+    resultados = Parallel(n_jobs=n_jobs)(
+        delayed(procesar_archivo)(nombre_archivo, contenido, anio_default_usuario)
+        for nombre_archivo, contenido in archivos_subidos
+    )
+    for periodos_archivo, ventas_archivo, errores_archivo, log_anio in resultados:
+        periodos.extend(periodos_archivo)
+        ventas.extend(ventas_archivo)
+        log_errores.extend(errores_archivo)
+        log_anios.append(log_anio)
+
+    if periodos:
+        # Consolidamos por mes con bincount sobre el índice de mes absoluto (año*12 + mes):
+        # suma las hojas del mismo mes y deja en 0 los meses faltantes, sin groupby ni reindex
+        periodos = np.asarray(periodos, dtype=np.int64)
+        primer_periodo = periodos.min()
+        totales = np.bincount(periodos - primer_periodo, weights=np.asarray(ventas, dtype=np.float64))
+        idx_completo = pd.date_range(
+            start=pd.Timestamp(year=primer_periodo // 12, month=primer_periodo % 12 + 1, day=1),
+            periods=len(totales), freq='MS', name='Fecha'
+        )
+        df_final = pd.DataFrame({'Ventas': totales}, index=idx_completo)
         return df_final, log_errores, log_anios
     else:
         return None, log_errores, log_anios
 
+@st.cache_resource(show_spinner=False)
+def ajustar_modelo(valores_bytes, fecha_inicio, periodos_estacionales=12):
+    valores = np.frombuffer(valores_bytes, dtype=np.float64)
+    # Ajustamos sobre la serie reescalada a O(1): con montos en miles/millones el optimizador de
+    # statsmodels converge peor y puede proyectar valores negativos. La proyección se multiplica por `escala`.
+    escala = np.abs(valores).mean() or 1.0
+    datos = pd.Series(valores / escala, index=pd.date_range(start=fecha_inicio, periods=len(valores), freq='MS'))
+
+    # Plan A: forzamos el modelo estacional (mínimo absoluto un año).
+    # Inicialización heurística (forma cerrada): el optimizador solo ajusta alfa/beta/gamma,
+    # no los 14 estados iniciales, y sin la búsqueda bruta previa converge mucho antes.
+    try:
+        if len(datos) >= periodos_estacionales:
+            modelo = ExponentialSmoothing(
+                datos,
+                trend='add',
+                seasonal='add',
+                seasonal_periods=periodos_estacionales,
+                initialization_method='heuristic'
+            ).fit(optimized=True, use_brute=False, method='L-BFGS-B')
+            return modelo, escala, True
+    except Exception:
+        # Si falla el forzado, seguimos silenciosamente al Plan B
+        pass
+
+    # Plan B: si falló el estacional o hay muy pocos datos, usamos Tendencia.
+    # Aquí se mantiene 'estimated': la heurística exige al menos 10 meses.
+    # Sin la búsqueda bruta previa: con tan pocos parámetros L-BFGS-B converge solo y ~2x más rápido.
+    modelo = ExponentialSmoothing(
+        datos,
+        trend='add',
+        seasonal=None,
+        damped_trend=True,
+        initialization_method='estimated'
+    ).fit(use_brute=False)
+    return modelo, escala, False
+
+@st.cache_data(show_spinner=False)
 def convertir_df_a_excel(df):
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         df.to_excel(writer, sheet_name='Proyeccion')
     return output.getvalue()
 
+def columnas_moneda(df):
+    # Formato "$1,234.57" aplicado en el navegador (el Styler formatea celda por celda en Python)
+    return {col: st.column_config.NumberColumn(format='dollar') for col in df.columns}
+
+def graficar_proyeccion(modo_prueba, historia, proyeccion, banda_inferior, banda_superior, realidad=None):
+    # Vega-Lite: el navegador dibuja el gráfico, en cada rerun solo viajan los datos
+    if modo_prueba:
+        lineas = {'Entrenamiento': historia, 'Realidad': realidad, 'IA (Auditada)': proyeccion}
+        colores = ['#2c3e50', 'green', '#e67e22']
+        discontinuas = ['IA (Auditada)']
+        marcadores = {'Realidad': realidad}
+        color_banda, opacidad_banda = '#e67e22', 0.1
+    else:
+        # La Base arranca en el último dato real para unir visualmente ambas curvas
+        lineas = {'Histórico': historia, 'Base': pd.concat([historia.iloc[-1:], proyeccion])}
+        colores = ['#2c3e50', '#e67e22']
+        discontinuas = ['Base']
+        marcadores = {'Base': proyeccion}
+        color_banda, opacidad_banda = '#f1c40f', 0.2
+
+    def a_largo(series):
+        return pd.concat([
+            pd.DataFrame({'Fecha': serie.index, 'Ventas': serie.to_numpy(), 'Serie': nombre})
+            for nombre, serie in series.items()
+        ])
+
+    df_banda = pd.DataFrame({
+        'Fecha': proyeccion.index,
+        'Inferior': np.asarray(banda_inferior),
+        'Superior': np.asarray(banda_superior)
+    })
+    eje_x = alt.X('Fecha:T', title=None)
+    formato_y = dict(title=None, axis=alt.Axis(format='$,.0f'), scale=alt.Scale(zero=False))
+    eje_y = alt.Y('Ventas:Q', **formato_y)
+    color = alt.Color('Serie:N', scale=alt.Scale(domain=list(lineas), range=colores), legend=alt.Legend(title=None, orient='top-left'))
+
+    capa_banda = alt.Chart(df_banda).mark_area(color=color_banda, opacity=opacidad_banda).encode(
+        x=eje_x, y=alt.Y('Inferior:Q', **formato_y), y2='Superior:Q'
+    )
+    capa_lineas = alt.Chart(a_largo(lineas)).mark_line().encode(
+        x=eje_x, y=eje_y, color=color,
+        strokeDash=alt.condition(alt.FieldOneOfPredicate(field='Serie', oneOf=discontinuas), alt.value([6, 4]), alt.value([1, 0]))
+    )
+    capa_puntos = alt.Chart(a_largo(marcadores)).mark_point(filled=True, size=50).encode(x=eje_x, y=eje_y, color=color)
+    return (capa_banda + capa_lineas + capa_puntos).properties(height=400)
+
 # --- FRONTEND ---
 
 st.title("🤖 Consola de Inteligencia Financiera v7.2")
@@ -111,7 +239,8 @@ if not uploaded_files:
     st.stop()
 
 with st.spinner('Analizando...'):
-    df_ventas, errores, log_anios = procesar_multiples_excels(uploaded_files, anio_default)
+    archivos = tuple((f.name, f.getvalue()) for f in uploaded_files)
+    df_ventas, errores, log_anios = procesar_multiples_excels(archivos, anio_default)
 
 with st.expander("✅ Auditoría de Archivos Detectados", expanded=False):
     for log in log_anios:
@@ -147,49 +276,31 @@ try:
         datos_modelo = df_ventas['Ventas']
 
     # --- CAMBIO CLAVE AQUÍ: Lógica "Forzada" ---
-    
-    # Intentamos forzar el modelo estacional primero (Plan A)
-    # Bajamos el requisito mínimo de 24 a 12 meses.
-    # Usamos initialization_method='estimated' para que sea más flexible.
-    modelo_exitoso = False
-    modelo = None
-    
-    try:
-        if len(datos_modelo) >= 12: # Mínimo absoluto un año
-            modelo = ExponentialSmoothing(
-                datos_modelo, 
-                trend='add', 
-                seasonal='add', 
-                seasonal_periods=12,
-                initialization_method='estimated' # ¡ESTA ES LA LLAVE MAESTRA!
-            ).fit()
-            modelo_exitoso = True
-            if modo_prueba:
-                 st.caption("✅ Auditoría usando Modelo Estacional (Forzado).")
-    except Exception as e_seasonal:
-        # Si falla el forzado, capturamos el error silenciosamente y seguimos al Plan B
-        pass
-    
-    # Plan B: Si falló el estacional o hay muy pocos datos, usamos Tendencia
-    if not modelo_exitoso:
-        modelo = ExponentialSmoothing(
-            datos_modelo, 
-            trend='add', 
-            seasonal=None, 
-            damped_trend=True,
-            initialization_method='estimated'
-        ).fit()
+    # El ajuste se cachea por contenido de la serie: mover los sliders no re-optimiza el modelo.
+    modelo, escala, modelo_exitoso = ajustar_modelo(
+        datos_modelo.to_numpy(dtype=np.float64).tobytes(),
+        datos_modelo.index[0]
+    )
+
+    if modelo_exitoso:
+        if modo_prueba:
+            st.caption("✅ Auditoría usando Modelo Estacional (Forzado).")
+    else:
         st.warning(f"⚠️ Nota: Usando Tendencia simple (Datos insuficientes para patrón anual robusto). Historia disponible: {len(datos_modelo)} meses.")
 
-    proyeccion = modelo.forecast(meses_proy)
+    proyeccion = modelo.forecast(meses_proy) * escala
     
     if modo_prueba:
-        errores_abs = abs(test - proyeccion)
-        mape = (errores_abs / test).mean() * 100
+        # MAPE sobre los ndarray: sin alinear índices ni crear Series intermedias
+        real_arr = test.to_numpy()
+        mape = np.mean(np.abs(real_arr - proyeccion.to_numpy()) / real_arr) * 100
         titulo = f"Auditoría: Precisión {100-mape:.1f}% (MAPE: {mape:.1f}%)"
     else:
-        opt = proyeccion * (1 + factor_riesgo)
-        pes = proyeccion * (1 - factor_riesgo)
+        # Una sola multiplicación para la banda; los escenarios quedan como ndarray
+        proy_arr = proyeccion.to_numpy()
+        banda = proy_arr * factor_riesgo
+        opt = proy_arr + banda
+        pes = proy_arr - banda
         titulo = f"Proyección Futura ({meses_proy} meses)"
 
 except Exception as e:
@@ -201,23 +312,11 @@ tab1, tab2, tab3 = st.tabs(["📊 Gráfico", "📋 Tabla Detallada", "🗂️ Hi
 
 with tab1:
     st.subheader(titulo)
-    fig, ax = plt.subplots(figsize=(12, 5))
-    plt.style.use('bmh')
-    
     if modo_prueba:
-        ax.plot(train.index, train, label='Entrenamiento', color='#2c3e50')
-        ax.plot(test.index, test, label='Realidad', color='green', marker='o')
-        ax.plot(proyeccion.index, proyeccion, label='IA (Auditada)', color='#e67e22', linestyle='--')
-        ax.fill_between(proyeccion.index, proyeccion*0.95, proyeccion*1.05, color='#e67e22', alpha=0.1)
+        grafico = graficar_proyeccion(True, train, proyeccion, proyeccion*0.95, proyeccion*1.05, test)
     else:
-        ax.plot(df_ventas.index, df_ventas['Ventas'], label='Histórico', color='#2c3e50')
-        ax.plot([df_ventas.index[-1], proyeccion.index[0]], [df_ventas['Ventas'].iloc[-1], proyeccion.iloc[0]], color='#e67e22', linestyle='--')
-        ax.plot(proyeccion.index, proyeccion, label='Base', color='#e67e22', linestyle='--', marker='o')
-        ax.fill_between(proyeccion.index, pes, opt, color='#f1c40f', alpha=0.2)
-
-    ax.legend()
-    ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'${x:,.0f}'))
-    st.pyplot(fig)
+        grafico = graficar_proyeccion(False, df_ventas['Ventas'], proyeccion, pes, opt)
+    st.altair_chart(grafico, use_container_width=True)
 
 with tab2:
     if modo_prueba:
@@ -226,11 +325,12 @@ with tab2:
             "IA": proyeccion, 
             "Diferencia": test - proyeccion
         })
-        st.dataframe(df_comp.style.format("${:,.2f}"), use_container_width=True)
+        st.dataframe(df_comp, column_config=columnas_moneda(df_comp), use_container_width=True)
     else:
-        df_det = pd.DataFrame({"Pesimista": pes, "Base": proyeccion, "Optimista": opt})
-        st.dataframe(df_det.style.format("${:,.2f}"), use_container_width=True)
-        st.download_button("📥 Descargar Excel", convertir_df_a_excel(df_det), "proyeccion.xlsx")
+        df_det = pd.DataFrame({"Pesimista": pes, "Base": proyeccion, "Optimista": opt}, index=proyeccion.index)
+        st.dataframe(df_det, column_config=columnas_moneda(df_det), use_container_width=True)
+        # El Excel se genera recién al hacer clic (en otro hilo), no en cada rerun
+        st.download_button("📥 Descargar Excel", lambda: convertir_df_a_excel(df_det), "proyeccion.xlsx")
 
 with tab3:
-    st.dataframe(df_ventas.sort_index(ascending=False).style.format("${:,.2f}"), use_container_width=True)
+    st.dataframe(df_ventas.sort_index(ascending=False), column_config=columnas_moneda(df_ventas), use_container_width=True)